@@ -2,63 +2,206 @@ import streamlit as st
 import requests
 import json
 import os
+import pickle
+import platform
+import queue
 import re
+import shutil
 import sqlite3
-from transformers import pipeline
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+import ahocorasick
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from transformers import AutoTokenizer, pipeline
+from optimum.onnxruntime import ORTModelForTokenClassification, ORTOptimizer, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoOptimizationConfig, AutoQuantizationConfig
 from pathlib import Path
-from thefuzz import process as fuzzy_process # Import the fuzzy matching library
+from huggingface_hub import hf_hub_download
+from rapidfuzz import fuzz, process as fuzzy_process, utils as fuzzy_utils # Import the fuzzy matching library
 
 # --- Page Configuration (Must be the first Streamlit command) ---
 st.set_page_config(page_title="🩺 Medical Safety Assistant", layout="wide", initial_sidebar_state="collapsed")
 
 # --- File Downloading Logic ---
-def download_file_from_hf(repo_id: str, filename: str, dest_path: str = "."):
-    local_path = Path(dest_path) / filename
-    if local_path.exists():
-        return str(local_path)
-    url = f"https://huggingface.co/datasets/{repo_id}/resolve/main/{filename}"
-    st.info(f"Downloading {filename}...")
-    try:
-        with requests.get(url, stream=True) as r:
-            r.raise_for_status()
-            with open(local_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        st.success(f"✅ Downloaded {filename}.")
-        return str(local_path)
-    except Exception as e:
-        st.error(f"Failed to download {filename}. Error: {e}")
-        return None
+def download_files_from_hf(repo_id: str, filenames: list[str], dest_path: str = "."):
+    """
+    Downloads any missing dataset files concurrently and returns their local paths,
+    in order, with None for files that failed to download.
+    """
+    for filename in filenames:
+        # Filenames are paths inside the dataset repo. A full URL (or an absolute/parent
+        # path) would never hit the exists() check below and could write outside dest_path.
+        if "://" in filename or Path(filename).is_absolute() or ".." in Path(filename).parts:
+            raise ValueError(f"Expected a dataset-relative filename, got {filename!r}")
+    local_paths = [Path(dest_path) / filename for filename in filenames]
+    missing = [filename for filename, local_path in zip(filenames, local_paths) if not local_path.exists()]
+    if not missing:
+        return [str(local_path) for local_path in local_paths]
+
+    st.info(f"Downloading {', '.join(missing)}...")
+    # huggingface_hub writes to a temporary file and resumes interrupted transfers
+    with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+        futures = {
+            filename: executor.submit(hf_hub_download, repo_id=repo_id, filename=filename, repo_type="dataset", local_dir=dest_path)
+            for filename in missing
+        }
+    paths = []
+    for filename, local_path in zip(filenames, local_paths):
+        if filename not in futures:
+            paths.append(str(local_path))
+            continue
+        try:
+            paths.append(futures[filename].result())
+            st.success(f"✅ Downloaded {filename}.")
+        except Exception as e:
+            st.error(f"Failed to download {filename}. Error: {e}")
+            paths.append(None)
+    return paths
 
 # --- Data and Model Loading ---
 DATA_REPO_ID = "FassikaF/medical-safety-app-data" 
 DB_FILENAME = "ddi_database.db"
 NDC_FILENAME = "drug_names.txt"
 DRUG_MAP_FILENAME = "drug_map.json"
+DRUG_DATA_CACHE_FILENAME = "drug_data.pkl"
+# Bump whenever the preprocessing in load_all_drug_data changes, to invalidate old caches
+DRUG_DATA_CACHE_VERSION = 2
+# The NER backbone can be swapped for a smaller distilled checkpoint (e.g. a
+# DistilBERT-based biomedical NER model) by setting NER_MODEL_ID in the environment
+NER_MODEL_ID = os.environ.get("NER_MODEL_ID", "d4data/biomedical-ner-all")
+NER_QUANTIZED_DIR = "ner-int8"
+NER_MAX_LENGTH = 256
+NER_BATCH_SIZE = 16
+NER_OPTIMIZED_FILENAME = "model_optimized.onnx"
+NER_QUANTIZED_FILENAME = "model_optimized_quantized.onnx"
+DDI_TABLE_MAX_ROWS = 500_000
+DDI_MEMORY_DB_MAX_BYTES = 100 * 1024 * 1024
+DDI_BATCH_MAX_PAIRS = 256
+DDI_PAIR_CACHE_MAX_ENTRIES = 16384
+# Words scored against the drug list per cdist call; bounds the score matrix to
+# chunk size x len(drug_list) bytes no matter how long the pasted input is
+FUZZY_QUERY_CHUNK_SIZE = 64
+LLM_MAX_WORKERS = 8
+LLM_CACHE_TTL_SECONDS = 24 * 60 * 60
+LLM_CACHE_MAX_ENTRIES = 1000
 
-db_path = download_file_from_hf(DATA_REPO_ID, DB_FILENAME)
-ndc_path = download_file_from_hf(DATA_REPO_ID, NDC_FILENAME)
-drug_map_path = download_file_from_hf(DATA_REPO_ID, DRUG_MAP_FILENAME)
+def _ner_quantization_preset() -> str:
+    """
+    Picks the int8 kernel preset for the host CPU: NEON dot-product on ARM, VNNI where the
+    CPU has it, and otherwise a reduced-range AVX-512 or AVX2 preset, since signed int8
+    weights can saturate on x86 hosts without VNNI.
+    """
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "arm64"
+    flags = set()
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    flags.update(line.split(":", 1)[1].split())
+                    break
+    except OSError:
+        pass  # No cpuinfo (e.g. macOS): assume the lowest common denominator below
+    if flags & {"avx512_vnni", "avx_vnni"}:
+        return "avx512_vnni"
+    if "avx512f" in flags:
+        return "avx512"
+    return "avx2"
 
-@st.cache_resource
 def load_ner_model():
+    """
+    Builds the NER pipeline. Runs on a background thread, so it makes no Streamlit calls;
+    any exception surfaces through the future returned by start_ner_model_loading.
+    """
+    # One quantized artifact per backbone and CPU preset, so switching models or moving
+    # the artifact to a different CPU never reuses a stale or mismatched export
+    preset = _ner_quantization_preset()
+    quantized_dir = Path(NER_QUANTIZED_DIR) / f"{NER_MODEL_ID.replace('/', '--')}--{preset}"
+    # Export to ONNX, fuse and quantize to int8 once; later boots reuse the artifact on disk
+    if not (quantized_dir / NER_QUANTIZED_FILENAME).exists():
+        # Build in a scratch directory and move it into place only once every file is
+        # written, so a boot killed mid-export (e.g. out of memory) never leaves behind a
+        # half-built artifact that every later boot would fail to load
+        quantized_dir.parent.mkdir(parents=True, exist_ok=True)
+        build_dir = Path(tempfile.mkdtemp(prefix=".build-", dir=quantized_dir.parent))
+        try:
+            onnx_model = ORTModelForTokenClassification.from_pretrained(NER_MODEL_ID, export=True)
+            # Fuse attention, GELU and LayerNorm subgraphs into ONNX Runtime's fused kernels
+            optimizer = ORTOptimizer.from_pretrained(onnx_model)
+            optimizer.optimize(save_dir=build_dir, optimization_config=AutoOptimizationConfig.O2())
+            quantizer = ORTQuantizer.from_pretrained(build_dir, file_name=NER_OPTIMIZED_FILENAME)
+            if preset in ("arm64", "avx512_vnni"):
+                qconfig = getattr(AutoQuantizationConfig, preset)(is_static=False, per_channel=False)
+            else:
+                qconfig = getattr(AutoQuantizationConfig, preset)(is_static=False, per_channel=False, reduce_range=True)
+            quantizer.quantize(save_dir=build_dir, quantization_config=qconfig)
+            AutoTokenizer.from_pretrained(NER_MODEL_ID, use_fast=True).save_pretrained(build_dir)
+            # Drop any partial artifact left by an older, non-atomic build before swapping in
+            shutil.rmtree(quantized_dir, ignore_errors=True)
+            os.replace(build_dir, quantized_dir)
+        finally:
+            # No-op after a successful replace; cleans up the scratch copy on failure
+            shutil.rmtree(build_dir, ignore_errors=True)
+    model = ORTModelForTokenClassification.from_pretrained(quantized_dir, file_name=NER_QUANTIZED_FILENAME)
+    # Force the Rust tokenizer and cap the sequence length; the pipeline truncates to
+    # model_max_length, so pathological pasted inputs can't blow up inference time
+    tokenizer = AutoTokenizer.from_pretrained(quantized_dir, use_fast=True)
+    tokenizer.model_max_length = NER_MAX_LENGTH
+    ner_pipeline = pipeline("ner", model=model, tokenizer=tokenizer, aggregation_strategy="simple")
+    # Warm up with a dummy forward pass so the first Analyze click doesn't pay for
+    # lazy kernel and tokenizer initialisation
+    ner_pipeline("warmup")
+    return ner_pipeline
+
+@st.cache_resource
+def start_ner_model_loading():
+    # Load the model in the background so the page (and the data downloads) don't wait
+    # on it; cached so each process starts exactly one load
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(load_ner_model)
+    executor.shutdown(wait=False)
+    return future
+
+def get_ner_pipeline():
+    """Returns the NER pipeline, blocking on the background load only when first needed."""
     try:
-        st.info("Loading Biomedical NER model...")
-        ner_pipeline = pipeline("ner", model="d4data/biomedical-ner-all", aggregation_strategy="simple")
-        st.success("✅ Biomedical NER model loaded.")
-        return ner_pipeline
+        with st.spinner("Loading Biomedical NER model..."):
+            return resources.ner_model_future.result()
     except Exception as e:
         st.error(f"Fatal: Could not load NER model. Error: {e}")
         return None
 
 @st.cache_resource
 def load_all_drug_data(map_filepath: str, list_filepath: str):
+    # Cold starts reuse the preprocessed map, list and automaton from disk as long as
+    # the source files are unchanged, skipping the JSON parse and automaton build
+    source_signature = [DRUG_DATA_CACHE_VERSION] + [
+        (path, os.stat(path).st_mtime_ns, os.stat(path).st_size) if path and os.path.exists(path) else (path, None, None)
+        for path in (map_filepath, list_filepath)
+    ]
+    cache_path = Path(DRUG_DATA_CACHE_FILENAME)
+    if cache_path.exists():
+        try:
+            with open(cache_path, "rb") as f:
+                cached = pickle.load(f)
+            if cached["source_signature"] == source_signature:
+                st.success(f"✅ Loaded {len(cached['drug_map'])} drug map variations and {len(cached['drug_list'])} drug names from cache.")
+                return cached["drug_map"], cached["drug_list"], cached["drug_automaton"]
+        except Exception:
+            pass  # Unreadable or outdated cache; rebuild from the source files below
+
     drug_map, drug_list = {}, []
     # Load the high-precision map
     if map_filepath and os.path.exists(map_filepath):
         try:
             with open(map_filepath, "r", encoding="utf-8") as f:
-                drug_map = json.load(f)
+                raw_drug_map = json.load(f)
+            # Canonicalize keys once so lookups never need to re-normalize them
+            drug_map = {variation.strip().lower(): canonical for variation, canonical in raw_drug_map.items()}
             st.success(f"✅ Loaded drug map with {len(drug_map)} variations.")
         except Exception as e:
             st.error(f"Failed to load drug map file: {e}")
@@ -67,89 +210,361 @@ def load_all_drug_data(map_filepath: str, list_filepath: str):
     if list_filepath and os.path.exists(list_filepath):
         try:
             with open(list_filepath, "r", encoding="utf-8") as f:
-                drug_list = [line.strip() for line in f if line.strip()]
+                # Drop case-only duplicates (keeping the first spelling): the fuzzy scorer
+                # lowercases both sides, so they only widen the score matrix
+                unique_names = {}
+                for line in f:
+                    name = line.strip()
+                    if name:
+                        unique_names.setdefault(name.lower(), name)
+                drug_list = list(unique_names.values())
             st.success(f"✅ Loaded drug list with {len(drug_list)} names for fuzzy matching.")
         except Exception as e:
             st.error(f"Failed to load drug list file: {e}")
-            
-    return drug_map, drug_list
 
-ner_pipeline = load_ner_model()
-drug_map, drug_list = load_all_drug_data(drug_map_path, ndc_path)
+    # Build a single Aho-Corasick automaton over every known surface form so that
+    # dictionary lookups are one pass over the input instead of one scan per drug.
+    # Map entries win over list entries since they carry the canonical name.
+    drug_automaton = ahocorasick.Automaton()
+    for name in drug_list:
+        drug_automaton.add_word(name.lower(), (name.lower(), name))
+    for variation, canonical in drug_map.items():
+        drug_automaton.add_word(variation, (variation, canonical))
+    if len(drug_automaton):
+        drug_automaton.make_automaton()
+
+    try:
+        # Write to a temporary file first so a crash never leaves a truncated cache behind
+        tmp_path = cache_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump({
+                "source_signature": source_signature,
+                "drug_map": drug_map,
+                "drug_list": drug_list,
+                "drug_automaton": drug_automaton,
+            }, f, protocol=5)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        st.warning(f"Could not cache preprocessed drug data: {e}")
+
+    return drug_map, drug_list, drug_automaton
+
+def _has_sorted_pair_columns(conn: sqlite3.Connection) -> bool:
+    """Whether the drug_lo/drug_hi migration has been applied to the DDI table."""
+    return "drug_lo" in {row[1] for row in conn.execute("PRAGMA table_xinfo(ddi_interactions)")}
+
+@st.cache_resource
+def get_ddi_conn(db_filepath: str):
+    """
+    Opens the single, long-lived connection to the DDI database, shared by every session.
+    """
+    if not db_filepath or not os.path.exists(db_filepath):
+        return None
+    try:
+        conn = sqlite3.connect(db_filepath, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-20000")
+        conn.execute("PRAGMA mmap_size=268435456")
+    except Exception as e:
+        st.error(f"Failed to open DDI database: {e}")
+        return None
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # One-time migration: generated columns holding the lowercased pair in sorted order,
+        # plus an index on them, so each pair is a single equality seek regardless of
+        # which way round it was stored
+        if not _has_sorted_pair_columns(conn):
+            conn.execute("ALTER TABLE ddi_interactions ADD COLUMN drug_lo TEXT GENERATED ALWAYS AS (MIN(LOWER(drug1), LOWER(drug2))) VIRTUAL")
+            conn.execute("ALTER TABLE ddi_interactions ADD COLUMN drug_hi TEXT GENERATED ALWAYS AS (MAX(LOWER(drug1), LOWER(drug2))) VIRTUAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ddi_sorted_pair ON ddi_interactions(drug_lo, drug_hi)")
+        conn.execute("PRAGMA optimize")
+    except sqlite3.Error as e:
+        # A read-only file or an SQLite without generated columns (older than 3.31) can't
+        # be migrated; load_ddi_table then builds the in-memory table with LOWER() instead
+        st.warning(f"Could not index the DDI database, using an in-memory table instead: {e}")
+    try:
+        # When the table is too big for the in-memory dict but the file is still small,
+        # serve lookups from a fully RAM-resident copy instead of going through the pager
+        (row_count,) = conn.execute("SELECT COUNT(*) FROM ddi_interactions").fetchone()
+        if (row_count > DDI_TABLE_MAX_ROWS and _has_sorted_pair_columns(conn)
+                and os.path.getsize(db_filepath) <= DDI_MEMORY_DB_MAX_BYTES):
+            memory_conn = sqlite3.connect(":memory:", check_same_thread=False, isolation_level=None)
+            conn.backup(memory_conn)
+            conn.close()
+            conn = memory_conn
+        # The app only ever reads from here on
+        conn.execute("PRAGMA query_only=1")
+        return conn
+    except Exception as e:
+        st.error(f"Failed to open DDI database: {e}")
+        return None
+
+@st.cache_resource
+def load_ddi_table(db_filepath: str):
+    """
+    Loads the read-only DDI table into a dict keyed by the sorted, lowercased drug pair,
+    so each interaction check is a dict lookup instead of a SQLite round-trip.
+    Returns None when the table is too large to hold in memory.
+    """
+    conn = get_ddi_conn(db_filepath)
+    if conn is None:
+        return None
+    try:
+        if _has_sorted_pair_columns(conn):
+            (row_count,) = conn.execute("SELECT COUNT(*) FROM ddi_interactions").fetchone()
+            if row_count > DDI_TABLE_MAX_ROWS:
+                # Lookups go through the indexed connection instead
+                return None
+            rows = conn.execute("SELECT drug_lo, drug_hi, level FROM ddi_interactions WHERE drug_lo IS NOT NULL").fetchall()
+        else:
+            # Unmigrated database: the indexed batch query can't run against it, so the
+            # dict is the only lookup path, whatever the table size
+            rows = conn.execute(
+                "SELECT MIN(LOWER(drug1), LOWER(drug2)), MAX(LOWER(drug1), LOWER(drug2)), level "
+                "FROM ddi_interactions WHERE drug1 IS NOT NULL AND drug2 IS NOT NULL"
+            ).fetchall()
+    except Exception as e:
+        st.error(f"Failed to load DDI database: {e}")
+        return None
+    ddi_table = {}
+    for drug1, drug2, level in rows:
+        # Interning shares each drug name string across all of its pairs
+        key = (sys.intern(drug1), sys.intern(drug2))
+        ddi_table.setdefault(key, level)
+    return ddi_table
+
+SharedState = namedtuple("SharedState", [
+    "ddi_lock", "ddi_pair_cache", "llm_details_lock", "llm_details_cache", "http_session",
+])
+
+@st.cache_resource
+def get_shared_state():
+    """
+    Returns the process-wide locks, caches and HTTP session. They don't depend on which
+    dataset files are present, so they survive a rebuild of the resource bundle.
+    """
+    return SharedState(
+        # Serializes use of the shared connection (and its pair cache) across concurrent sessions
+        ddi_lock=threading.Lock(),
+        # Process-wide LRU of SQLite lookups: sorted pair -> level, or None for no interaction.
+        # Common drugs recur across sessions, so repeat pairs skip SQLite entirely.
+        ddi_pair_cache=OrderedDict(),
+        # Guards the LLM cache, which every session's worker threads write to
+        llm_details_lock=threading.Lock(),
+        # st.cache_data cannot memoize a streamed response, so finished analyses are kept in
+        # a process-wide LRU shared by all sessions: key -> (created_at, details)
+        llm_details_cache=OrderedDict(),
+        # One pooled session per process so API calls reuse keep-alive connections
+        # instead of paying a new TCP/TLS handshake every request
+        http_session=requests.Session(),
+    )
+
+Resources = namedtuple("Resources", [
+    "ner_model_future", "drug_map", "drug_list", "drug_automaton",
+    "ddi_conn", "ddi_lock", "ddi_pair_cache", "ddi_table", "llm_details_lock", "llm_details_cache",
+    "http_session",
+])
+
+@st.cache_resource
+def get_resources(db_filepath: str, list_filepath: str, map_filepath: str):
+    """
+    Bundles every process-wide resource, so a script rerun costs a single cache lookup.
+    Keyed by the dataset paths: when a retried download lands, only the loaders for the
+    newly available file do any work; the rest are hits on their own path-keyed caches.
+    """
+    shared_state = get_shared_state()
+    drug_map, drug_list, drug_automaton = load_all_drug_data(map_filepath, list_filepath)
+    return Resources(
+        ner_model_future=start_ner_model_loading(),
+        drug_map=drug_map,
+        drug_list=drug_list,
+        drug_automaton=drug_automaton,
+        ddi_conn=get_ddi_conn(db_filepath),
+        ddi_lock=shared_state.ddi_lock,
+        ddi_pair_cache=shared_state.ddi_pair_cache,
+        ddi_table=load_ddi_table(db_filepath),
+        llm_details_lock=shared_state.llm_details_lock,
+        llm_details_cache=shared_state.llm_details_cache,
+        http_session=shared_state.http_session,
+    )
+
+# Start the NER load before the downloads so the two overlap on a cold start
+start_ner_model_loading()
+# Not cached: once the files exist this is a few stat calls, and a failed download is
+# retried on the next rerun
+db_path, ndc_path, drug_map_path = download_files_from_hf(DATA_REPO_ID, [DB_FILENAME, NDC_FILENAME, DRUG_MAP_FILENAME])
+resources = get_resources(db_path, ndc_path, drug_map_path)
 
 # --- Core Logic Functions ---
-def extract_terms(text: str):
+# Splits input into candidate words on whitespace, commas and periods
+TERM_SPLITTER = re.compile(r"[\s,.]+")
+# Connective and dosing words that never name a drug; ignored when deciding whether
+# the dictionary already covered an input
+NON_DRUG_WORDS = frozenset({
+    "a", "an", "and", "also", "or", "plus", "with", "the", "of", "on", "for", "to",
+    "taking", "takes", "daily", "tablet", "tablets", "mg", "mcg", "g", "ml",
+})
+# Inputs whose remaining unexplained words fall below this share skip NER entirely
+NER_SKIP_UNCOVERED_RATIO = 0.2
+
+def _word_boundary_ok(text: str, start: int, end: int) -> bool:
+    """Equivalent of a regex `\\b...\\b` check around text[start:end + 1]."""
+    before_ok = start == 0 or not (text[start - 1].isalnum() or text[start - 1] == "_")
+    after_ok = end + 1 >= len(text) or not (text[end + 1].isalnum() or text[end + 1] == "_")
+    return before_ok and after_ok
+
+def extract_terms_batch(texts: list[str]) -> list[list[str]]:
     """
-    Extracts medical terms using a robust three-layer defense system:
-    1. High-precision canonical name map.
-    2. High-recall biomedical NER model.
+    Extracts medical terms from several inputs using a robust three-layer defense system:
+    1. High-precision dictionary match (canonical map + drug list).
+    2. High-recall biomedical NER model, batched over the inputs the dictionary didn't cover.
     3. Fuzzy string matching safety net.
     """
-    if not text.strip():
-        return []
-    
-    found_canonical_terms = set()
-    
-    # Pre-process text: lowercase and split into potential terms
-    potential_terms = set(text.lower().replace(',', ' ').replace('.', ' ').split())
-
-    # --- Layer 1: High-Precision Canonical Map ---
-    words_to_check_further = set()
-    for term in potential_terms:
-        if term in drug_map:
-            found_canonical_terms.add(drug_map[term])
-        else:
-            words_to_check_further.add(term)
+    found_terms_per_text = [set() for _ in texts]
+    words_per_text = [set() for _ in texts]
+    ner_indices = []
+
+    for i, text in enumerate(texts):
+        if not text.strip():
+            continue
+
+        # Pre-process text: lowercase and split into potential terms
+        lower_text = text.lower()
+        potential_terms = set(TERM_SPLITTER.split(lower_text))
+        potential_terms.discard("")
+
+        # --- Layer 1: High-Precision Dictionary Match ---
+        # A single automaton pass finds every known name (including multi-word ones)
+        covered_words = set()
+        if len(resources.drug_automaton):
+            for end_idx, (surface, canonical) in resources.drug_automaton.iter(lower_text):
+                start_idx = end_idx - len(surface) + 1
+                if _word_boundary_ok(lower_text, start_idx, end_idx):
+                    found_terms_per_text[i].add(canonical)
+                    covered_words.update(TERM_SPLITTER.split(surface))
+        words_per_text[i] = potential_terms - covered_words
+
+        # Skip NER when the dictionary already explains (almost) every word: the model
+        # would add no recall but cost a full forward pass
+        uncovered_words = {word for word in words_per_text[i] if word not in NON_DRUG_WORDS and not word.isdigit()}
+        uncovered_ratio = len(uncovered_words) / max(1, len(potential_terms))
+        if not (found_terms_per_text[i] and uncovered_ratio < NER_SKIP_UNCOVERED_RATIO):
+            ner_indices.append(i)
 
     # --- Layer 2: High-Recall Biomedical NER ---
-    # Run NER on the original, unprocessed text for best results
+    # Run NER on the original, unprocessed texts for best results. Every line of every
+    # input the dictionary didn't fully cover goes through a single batched pipeline call;
+    # short per-line sequences pad tightly and never hit the truncation limit.
+    ner_segments = [(i, line) for i in ner_indices for line in texts[i].splitlines() if line.strip()]
+    ner_pipeline = get_ner_pipeline() if ner_segments else None
     if ner_pipeline:
         try:
-            entities = ner_pipeline(text)
-            for entity in entities:
-                term = entity['word'].strip().lower().replace("##", "")
-                # Check if the found term is a key in our map to get the canonical name
-                if term in drug_map:
-                    found_canonical_terms.add(drug_map[term])
-                else: # Otherwise, add the term as is
-                    found_canonical_terms.add(term)
+            batch_entities = ner_pipeline([line for _, line in ner_segments], batch_size=NER_BATCH_SIZE)
+            for (i, _), entities in zip(ner_segments, batch_entities):
+                for entity in entities:
+                    term = entity['word'].strip().lower().replace("##", "")
+                    # Check if the found term is a key in our map to get the canonical name
+                    if term in resources.drug_map:
+                        found_terms_per_text[i].add(resources.drug_map[term])
+                    else: # Otherwise, add the term as is
+                        found_terms_per_text[i].add(term)
         except Exception as e:
             st.warning(f"NER extraction had an issue: {e}")
 
     # --- Layer 3: Fuzzy Matching Safety Net ---
-    if drug_list:
-        # Check remaining words that weren't found in the map
-        for term in words_to_check_further:
-            # Find the best match from our full drug list
-            # We use a high threshold (e.g., 90) to avoid incorrect matches
-            best_match = fuzzy_process.extractOne(term, drug_list, score_cutoff=90)
-            if best_match:
-                # best_match is a tuple: ('matched_word', score)
-                found_canonical_terms.add(best_match[0])
+    # Check remaining words that weren't found in the map, across all inputs at once
+    words_to_check_further = [(i, term) for i, words in enumerate(words_per_text) for term in words]
+    if resources.drug_list and words_to_check_further:
+        # Score words against our full drug list in multi-threaded calls, a bounded chunk
+        # of words at a time and with one byte per score to keep the matrix small
+        # We use a high threshold (e.g., 90) to avoid incorrect matches
+        for chunk_start in range(0, len(words_to_check_further), FUZZY_QUERY_CHUNK_SIZE):
+            chunk = words_to_check_further[chunk_start:chunk_start + FUZZY_QUERY_CHUNK_SIZE]
+            scores = fuzzy_process.cdist(
+                [term for _, term in chunk], resources.drug_list,
+                scorer=fuzz.WRatio, processor=fuzzy_utils.default_process, score_cutoff=90,
+                dtype=np.uint8, workers=-1
+            )
+            best_indices = scores.argmax(axis=1)
+            for (i, _), word_scores, best_index in zip(chunk, scores, best_indices):
+                # Scores below the cutoff come back as 0
+                if word_scores[best_index] >= 90:
+                    found_terms_per_text[i].add(resources.drug_list[best_index])
                 
-    return list(found_canonical_terms)
+    return [list(found_canonical_terms) for found_canonical_terms in found_terms_per_text]
 
-def query_ddi_database(drug1: str, drug2: str):
-    # This function is unchanged
-    if not db_path or not os.path.exists(db_path):
+# Probes every sorted pair in a single statement. Joining against a VALUES list (rather
+# than a row-value IN) lets SQLite seek idx_ddi_sorted_pair once per pair.
+DDI_BATCH_QUERY = "WITH q(a, b) AS (VALUES {values}) SELECT d.drug_lo, d.drug_hi, d.level FROM q JOIN ddi_interactions d ON d.drug_lo = q.a AND d.drug_hi = q.b"
+
+def _ddi_batch_query(pair_count: int):
+    """
+    Returns (padded_count, sql) for a batch of pair_count pairs. Rounding up to a power
+    of two keeps the number of distinct statements tiny, so each stays prepared in the
+    connection's statement cache instead of being re-parsed and re-planned per click.
+    """
+    padded_count = 1 << (pair_count - 1).bit_length()
+    return padded_count, DDI_BATCH_QUERY.format(values=", ".join(["(?, ?)"] * padded_count))
+
+def query_ddi_database_batch(pairs: list[tuple[str, str]]):
+    """
+    Checks every (drug1, drug2) pair against the DDI database in one pass and returns
+    a dict mapping each interacting pair, exactly as given, to its interaction level.
+    """
+    keys = {pair: tuple(sorted((pair[0].lower(), pair[1].lower()))) for pair in pairs}
+    if resources.ddi_table is not None:
+        levels = {key: resources.ddi_table.get(key) for key in set(keys.values())}
+    elif resources.ddi_conn is not None:
+        levels = {}
+        with resources.ddi_lock:
+            for key in set(keys.values()):
+                if key in resources.ddi_pair_cache:
+                    resources.ddi_pair_cache.move_to_end(key)
+                    levels[key] = resources.ddi_pair_cache[key]
+        unique_keys = [key for key in set(keys.values()) if key not in levels]
+        # Chunk very large batches to stay under SQLite's bound-parameter limit
+        for chunk_start in range(0, len(unique_keys), DDI_BATCH_MAX_PAIRS):
+            chunk = unique_keys[chunk_start:chunk_start + DDI_BATCH_MAX_PAIRS]
+            padded_count, query = _ddi_batch_query(len(chunk))
+            # Padding repeats the last pair; duplicate hits collapse in the dict below
+            padded_chunk = chunk + [chunk[-1]] * (padded_count - len(chunk))
+            params = [name for key in padded_chunk for name in key]
+            with resources.ddi_lock:
+                rows = resources.ddi_conn.execute(query, params).fetchall()
+            for drug_lo, drug_hi, level in rows:
+                levels.setdefault((drug_lo, drug_hi), level)
+        # Remember misses too, so non-interacting pairs are also served from the cache
+        with resources.ddi_lock:
+            for key in unique_keys:
+                resources.ddi_pair_cache[key] = levels.get(key)
+            while len(resources.ddi_pair_cache) > DDI_PAIR_CACHE_MAX_ENTRIES:
+                resources.ddi_pair_cache.popitem(last=False)
+    else:
         st.error("Database file not available for query.")
-        return None
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    query = "SELECT level FROM ddi_interactions WHERE (LOWER(drug1) = ? AND LOWER(drug2) = ?) OR (LOWER(drug1) = ? AND LOWER(drug2) = ?)"
-    cursor.execute(query, (drug1.lower(), drug2.lower(), drug2.lower(), drug1.lower()))
-    result = cursor.fetchone()
-    conn.close()
-    return {"level": result[0]} if result else None
-
-def get_llm_details_from_openrouter(drug1: str, drug2: str, level: str):
+        return {}
+    return {pair: levels[key] for pair, key in keys.items() if levels.get(key) is not None}
+
+def get_llm_details_from_openrouter(api_key: str, drug1: str, drug2: str, level: str, chunks: queue.Queue):
     """
     Calls the OpenRouter API with a verified, top-tier model and required headers.
+    The response is streamed: content deltas are put on `chunks` as they arrive,
+    followed by a `None` sentinel. Runs on worker threads, so it makes no Streamlit
+    calls (the API key is read on the script thread and passed in) and instead
+    returns an error message (or None) for the caller to render.
     """
-    api_key = st.secrets.get("OPENROUTER_API_KEY")
+    try:
+        return _stream_llm_details_from_openrouter(api_key, drug1, drug2, level, chunks)
+    finally:
+        chunks.put(None)
+
+def _llm_cache_key(drug1: str, drug2: str, level: str):
+    return (*sorted((drug1.lower(), drug2.lower())), level)
+
+def _stream_llm_details_from_openrouter(api_key: str, drug1: str, drug2: str, level: str, chunks: queue.Queue):
     if not api_key:
-        st.error("OpenRouter API key not found. Please set it in your Streamlit secrets.")
-        return "Analysis unavailable: API key is missing."
+        chunks.put("Analysis unavailable: API key is missing.")
+        return "OpenRouter API key not found. Please set it in your Streamlit secrets."
 
     # Your app URL (make sure this is correct)
     your_app_url = "https://fassikaf-med-safety-app-app-axpxqg.streamlit.app/"
@@ -189,22 +604,49 @@ def get_llm_details_from_openrouter(drug1: str, drug2: str, level: str):
         # Replaced the delisted model with the new, state-of-the-art Llama 3 model.
         "model": "meta-llama/llama-3-8b-instruct", 
         "max_tokens": 400,
+        "stream": True,
         "messages": [
             {"role": "system", "content": "You are a helpful medical safety assistant providing expert-level summaries to healthcare professionals."},
             {"role": "user", "content": prompt}
         ]
     }
 
+    parts = []
+    done = False
     try:
-        response = requests.post(
+        with resources.http_session.post(
             url="https://openrouter.ai/api/v1/chat/completions",
             headers=headers,
-            json=json_payload
-        )
-        response.raise_for_status() 
-        result = response.json()
-        return result['choices'][0]['message']['content'].strip()
-    
+            json=json_payload,
+            stream=True
+        ) as response:
+            response.raise_for_status()
+            response.encoding = "utf-8"
+            # Server-sent events: one "data: {...}" line per delta, ":" lines are keep-alive comments
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    done = True
+                    break
+                event = json.loads(data)
+                if "error" in event:
+                    chunks.put("Error retrieving detailed analysis from the API.")
+                    return f"API Error: {json.dumps(event['error'], indent=2)}"
+                content = event['choices'][0]['delta'].get('content')
+                if content:
+                    parts.append(content)
+                    chunks.put(content)
+        # Only complete, successful analyses are cached; a stream cut off before [DONE]
+        # (or one that produced no text) is shown once but never replayed
+        if done and parts:
+            with resources.llm_details_lock:
+                resources.llm_details_cache[_llm_cache_key(drug1, drug2, level)] = (time.time(), "".join(parts))
+                while len(resources.llm_details_cache) > LLM_CACHE_MAX_ENTRIES:
+                    resources.llm_details_cache.popitem(last=False)
+        return None
+
     except requests.exceptions.RequestException as e:
         error_details = "No additional details in response."
         if e.response is not None:
@@ -214,8 +656,44 @@ def get_llm_details_from_openrouter(drug1: str, drug2: str, level: str):
             except json.JSONDecodeError:
                 error_details = e.response.text
                 
-        st.error(f"API Error: {e}\n\nServer Response:\n```\n{error_details}\n```")
-        return "Error retrieving detailed analysis from the API."
+        chunks.put("Error retrieving detailed analysis from the API.")
+        return f"API Error: {e}\n\nServer Response:\n```\n{error_details}\n```"
+
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+        # Malformed server-sent event (bad JSON, or no choices[0].delta): report it like any
+        # other API failure rather than letting it escape through future.result()
+        chunks.put("Error retrieving detailed analysis from the API.")
+        return f"API Error: Could not parse the streamed response: {e!r}"
+
+def start_llm_details(executor: ThreadPoolExecutor, drug1: str, drug2: str, level: str):
+    """
+    Submits an LLM request to the worker pool and returns its (chunks, future) handle.
+    Cached analyses younger than LLM_CACHE_TTL_SECONDS are replayed without a network call.
+    """
+    chunks = queue.Queue()
+    cache_key = _llm_cache_key(drug1, drug2, level)
+    with resources.llm_details_lock:
+        cached = resources.llm_details_cache.get(cache_key)
+        if cached:
+            resources.llm_details_cache.move_to_end(cache_key)
+    if cached and time.time() - cached[0] < LLM_CACHE_TTL_SECONDS:
+        chunks.put(cached[1])
+        chunks.put(None)
+        future = Future()
+        future.set_result(None)
+        return chunks, future
+    # Sort the pair so (A, B) and (B, A) send the same prompt and share a cache entry
+    drug1, drug2 = sorted((drug1, drug2), key=str.lower)
+    api_key = st.secrets.get("OPENROUTER_API_KEY")
+    return chunks, executor.submit(get_llm_details_from_openrouter, api_key, drug1, drug2, level, chunks)
+
+def render_llm_details(llm_request):
+    """Renders a submitted LLM request token by token as its chunks arrive."""
+    chunks, future = llm_request
+    st.write_stream(iter(chunks.get, None))
+    error_message = future.result()
+    if error_message:
+        st.error(error_message)
 
 
 # --- Streamlit User Interface  ---
@@ -232,29 +710,28 @@ if st.button("🔎 Analyze for Safety", use_container_width=True):
         st.warning("Please fill in both fields.")
     else:
         with st.spinner("Analyzing..."):
-            current_terms = extract_terms(current_input)
-            new_terms = extract_terms(new_input)
+            current_terms, new_terms = extract_terms_batch([current_input, new_input])
             st.markdown("---")
             st.subheader("🔬 Analysis Results")
             st.markdown(f"**Detected Terms (Current):** `{', '.join(current_terms) if current_terms else 'None'}`")
             st.markdown(f"**Detected Terms (New):** `{', '.join(new_terms) if new_terms else 'None'}`")
             st.markdown("---")
             if current_terms and new_terms:
-                interaction_found = False
-                for drug1 in current_terms:
-                    for drug2 in new_terms:
-                        ddi = query_ddi_database(drug1, drug2)
-                        if ddi:
-                            interaction_found = True
-                            level = ddi['level'].lower()
+                # Collect every known interaction first so all LLM calls can run concurrently
+                pairs = [(drug1, drug2) for drug1 in current_terms for drug2 in new_terms]
+                levels = query_ddi_database_batch(pairs)
+                interactions = [(drug1, drug2, levels[(drug1, drug2)].lower()) for drug1, drug2 in pairs if (drug1, drug2) in levels]
+                with ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS) as executor:
+                    if interactions:
+                        llm_requests = [start_llm_details(executor, *interaction) for interaction in interactions]
+                        # Render in order; later results keep arriving while earlier ones are shown
+                        for (drug1, drug2, level), llm_request in zip(interactions, llm_requests):
                             st.markdown(f"#### Interaction Found: **{drug1.title()} & {drug2.title()}**")
                             st.markdown(f"**Risk Level:** `{level.upper()}`")
-                            details = get_llm_details_from_openrouter(drug1, drug2, level)
-                            st.markdown(details)
-                if not interaction_found:
-                    st.info("No specific interaction found in the database. A general analysis will now be performed using the first detected terms.")
-                    details = get_llm_details_from_openrouter(current_terms[0], new_terms[0], "unknown")
-                    st.markdown(details)
+                            render_llm_details(llm_request)
+                    else:
+                        st.info("No specific interaction found in the database. A general analysis will now be performed using the first detected terms.")
+                        render_llm_details(start_llm_details(executor, current_terms[0], new_terms[0], "unknown"))
             else:
                 st.error("Could not detect enough medical terms to perform an analysis.")
 else: